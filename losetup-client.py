@@ -3,74 +3,250 @@
 # SPDX-License-Identifier: GPL-3.0-only
 """Client for losetup-server, intended as a drop-in replacement for losetup."""
 
+import functools
+import http.client
 import json
 import os
-import subprocess
+import shlex
+import socket
+import struct
 import sys
-import urllib.request
-import urllib.error
+import time
+from collections.abc import Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 DEFAULT_PORT = 12345
+LOSETUP_PATH = "/losetup"
+BATCH_PATH = "/losetup/batch"
+JSON_TYPE = "application/json"
+NDJSON_TYPE = "application/x-ndjson"
+HEADERS = {"Content-Type": JSON_TYPE, "Accept": f"{NDJSON_TYPE}, {JSON_TYPE}"}
+
+GATEWAY_CACHE = "/run/losetup-client-gateway"
+GATEWAY_CACHE_TTL = 30
+
+
+# rtnetlink(7) message layouts and constants
+NLMSGHDR = struct.Struct("=IHHII")
+RTATTR = struct.Struct("=HH")
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+
+def netlink_dump(msg_type: int, request: bytes) -> Iterator[bytes]:
+    """Send an rtnetlink dump request and yield the body of each reply."""
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as sock:
+        sock.bind((0, 0))
+        header = NLMSGHDR.pack(
+            NLMSGHDR.size + len(request), msg_type, NLM_F_REQUEST | NLM_F_DUMP, 1, 0
+        )
+        sock.send(header + request)
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset < len(data):
+                length, reply_type, _, _, _ = NLMSGHDR.unpack_from(data, offset)
+                if reply_type == NLMSG_DONE:
+                    return
+                if reply_type == NLMSG_ERROR:
+                    (error,) = struct.unpack_from("=i", data, offset + NLMSGHDR.size)
+                    raise OSError(-error, os.strerror(-error))
+                yield data[offset + NLMSGHDR.size:offset + length]
+                offset += (length + 3) & ~3
+
+
+def parse_attrs(data: bytes, offset: int) -> dict[int, bytes]:
+    """Parse the rtattrs starting at offset into a dict of type to payload."""
+    attrs = {}
+    while offset + RTATTR.size <= len(data):
+        length, attr_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attrs[attr_type] = data[offset + RTATTR.size:offset + length]
+        offset += (length + 3) & ~3
+    return attrs
+
+
+RTMSG = struct.Struct("=BBBBBBBBI")
+RTM_GETROUTE = 26
+RTA_GATEWAY = 5
+RTA_TABLE = 15
+RT_TABLE_MAIN = 254
+
+
+def lookup_default_gateway() -> str:
+    """Look up the default IPv4 gateway address in the routing table."""
+    request = RTMSG.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)
+    try:
+        for reply in netlink_dump(RTM_GETROUTE, request):
+            _, dst_len, _, _, table, _, _, _, _ = RTMSG.unpack_from(reply)
+            attrs = parse_attrs(reply, RTMSG.size)
+            if RTA_TABLE in attrs:
+                (table,) = struct.unpack("=I", attrs[RTA_TABLE])
+            if dst_len == 0 and table == RT_TABLE_MAIN and RTA_GATEWAY in attrs:
+                return socket.inet_ntoa(attrs[RTA_GATEWAY])
+    except OSError as e:
+        raise RuntimeError(f"Failed to get default route: {e}") from e
 
+    raise RuntimeError("No default gateway found")
 
-def get_default_gateway() -> str:
-    """Get the default IPv4 gateway address."""
-    result = subprocess.run(
-        ["ip", "-j", "route", "show", "default"],
-        capture_output=True,
-        text=True,
-    )
-    if result.returncode != 0:
-        raise RuntimeError(f"Failed to get default route: {result.stderr}")
 
-    routes = json.loads(result.stdout)
-    if routes and "gateway" in routes[0]:
-        return routes[0]["gateway"]
+def read_cached_gateway() -> str | None:
+    """Return the cached gateway address, or None if it is missing or stale."""
+    try:
+        with open(GATEWAY_CACHE) as f:
+            if time.time() - os.fstat(f.fileno()).st_mtime >= GATEWAY_CACHE_TTL:
+                return None
+            return f.read().strip() or None
+    except OSError:
+        return None
+
 
-    raise RuntimeError("No default gateway found")
+def write_cached_gateway(gateway: str) -> None:
+    """Atomically save the gateway address for later invocations."""
+    tmp_path = f"{GATEWAY_CACHE}.{os.getpid()}"
+    try:
+        with open(tmp_path, "w") as f:
+            f.write(gateway)
+        os.replace(tmp_path, GATEWAY_CACHE)
+    except OSError:
+        # The cache is only an optimization, e.g. /run may not be writable
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+
+@functools.cache
+def get_default_gateway() -> str:
+    """Get the default IPv4 gateway address, using the on-disk cache if fresh."""
+    gateway = read_cached_gateway()
+    if gateway is None:
+        gateway = lookup_default_gateway()
+        write_cached_gateway(gateway)
+    return gateway
 
 
 def convert_paths(args: list[str]) -> list[str]:
     """Convert file paths to be relative to container root."""
-    result = []
-    for arg in args:
-        if arg.startswith("-") or arg.startswith("/dev/"):
-            result.append(arg)
-        else:
-            # Convert to absolute path, then strip leading slash
-            abs_path = os.path.abspath(arg)
-            result.append(abs_path[1:])
-    return result
-
+    # os.path.abspath() calls getcwd() for every path, so look it up once
+    cwd = os.getcwd()
+    return [
+        arg if arg.startswith(("-", "/dev/"))
+        # Convert to absolute path, then strip leading slash
+        else os.path.normpath(os.path.join(cwd, arg))[1:]
+        for arg in args
+    ]
+
+
+def dumps(obj) -> bytes:
+    """Serialize obj to JSON bytes, using orjson if it is available."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+
+def loads(data: bytes):
+    """Deserialize JSON bytes, using orjson if it is available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def post_json(
+    conn: http.client.HTTPConnection, path: str, payload: dict
+) -> http.client.HTTPResponse:
+    """POST a JSON payload to the server over conn and return the response."""
+    conn.request(
+        "POST",
+        path,
+        body=dumps(payload),
+        headers=HEADERS,
+    )
+    return conn.getresponse()
 
-def main():
-    gateway = get_default_gateway()
-    server_url = f"http://{gateway}:{DEFAULT_PORT}"
 
-    url = f"{server_url}/losetup"
-    args = convert_paths(sys.argv[1:])
-    data = json.dumps({"args": args}).encode()
+def read_batch(lines) -> list[dict]:
+    """Build batch operations from lines of losetup arguments, one per line."""
+    return [
+        {"args": convert_paths(shlex.split(line))}
+        for line in lines
+        if line.strip()
+    ]
 
-    req = urllib.request.Request(
-        url,
-        data=data,
-        headers={"Content-Type": "application/json"},
-        method="POST",
-    )
-
-    try:
-        with urllib.request.urlopen(req) as response:
-            result = json.loads(response.read())
-    except urllib.error.URLError as e:
-        print(f"Error connecting to server: {e}", file=sys.stderr)
-        sys.exit(1)
 
+def print_result(result: dict) -> int:
+    """Print the output of one losetup run and return its exit status."""
+    if result.get("error"):
+        print(f"Server error: {result['error']}", file=sys.stderr)
     if result.get("stdout"):
         print(result["stdout"], end="")
     if result.get("stderr"):
         print(result["stderr"], end="", file=sys.stderr)
+    return result.get("returncode", 1)
+
+
+def print_stream(response: http.client.HTTPResponse) -> int:
+    """Print a streamed losetup run as it arrives and return its exit status."""
+    for line in response:
+        message = loads(line)
+        if "stdout" in message:
+            print(message["stdout"], end="", flush=True)
+        else:
+            # The final message carries the exit status and stderr
+            return print_result(message)
+    print("Server closed the connection early", file=sys.stderr)
+    return 1
+
 
-    sys.exit(result.get("returncode", 1))
+def main():
+    gateway = get_default_gateway()
+    conn = http.client.HTTPConnection(gateway, DEFAULT_PORT)
+
+    # With --batch, read one set of losetup arguments per line of stdin and
+    # run them all with a single request.
+    batch = sys.argv[1:] == ["--batch"]
+    if batch:
+        path = BATCH_PATH
+        payload = {"ops": read_batch(sys.stdin)}
+    else:
+        path = LOSETUP_PATH
+        payload = {"args": convert_paths(sys.argv[1:])}
+
+    try:
+        response = post_json(conn, path, payload)
+        content_type = response.getheader("Content-Type", "")
+        if content_type.startswith(NDJSON_TYPE):
+            sys.exit(print_stream(response))
+        if not content_type.startswith(JSON_TYPE):
+            # e.g. a plain-text 500 from the server
+            raise ValueError(f"HTTP {response.status} {response.reason}")
+        result = loads(response.read())
+    except (OSError, http.client.HTTPException) as e:
+        print(f"Error connecting to server: {e}", file=sys.stderr)
+        sys.exit(1)
+    except ValueError as e:
+        print(f"Invalid response from server: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        conn.close()
+
+    if not batch or not isinstance(result, list):
+        sys.exit(print_result(result))
+
+    # Exit with the status of the first operation that failed
+    returncode = 0
+    for op_result in result:
+        op_returncode = print_result(op_result)
+        if returncode == 0:
+            returncode = op_returncode
+    sys.exit(returncode)
 
 
 if __name__ == "__main__":
@@ -10,13 +10,27 @@ to handle loop device creation via the losetup-server.
 """
 
 import os
-import subprocess
 import sys
 
 REAL_MOUNT = "/usr/bin/mount.REAL"
 LOSETUP = "losetup"
 
 
+# Flags whose value is given in the following argument
+FLAGS_WITH_ARG = frozenset(
+    {"-t", "--types", "-L", "-U", "--source", "--target", "-o", "--options"}
+)
+OPTIONS_FLAGS = frozenset({"-o", "--options"})
+
+
+def parse_options(value: str) -> dict:
+    """Parse a comma-separated mount options string into a dict."""
+    return {
+        key: (val if sep else None)
+        for key, sep, val in (opt.partition("=") for opt in value.split(","))
+    }
+
+
 def parse_mount_args(args: list[str]) -> tuple[dict, list[str], str | None, str | None]:
     """
     Parse mount arguments to extract options, flags, source, and target.
@@ -29,34 +43,22 @@ def parse_mount_args(args: list[str]) -> tuple[dict, list[str], str | None, str
     positional = []
 
     i = 0
-    while i < len(args):
+    n = len(args)
+    while i < n:
         arg = args[i]
-        if arg in ("-o", "--options"):
-            if i + 1 < len(args):
-                for opt in args[i + 1].split(","):
-                    if "=" in opt:
-                        key, value = opt.split("=", 1)
-                        options[key] = value
-                    else:
-                        options[opt] = None
+        if arg in FLAGS_WITH_ARG:
+            if i + 1 < n:
+                if arg in OPTIONS_FLAGS:
+                    options.update(parse_options(args[i + 1]))
+                else:
+                    flags.extend([arg, args[i + 1]])
                 i += 2
                 continue
+            if arg not in OPTIONS_FLAGS:
+                flags.append(arg)
         elif arg.startswith("-o"):
-            for opt in arg[2:].split(","):
-                if "=" in opt:
-                    key, value = opt.split("=", 1)
-                    options[key] = value
-                else:
-                    options[opt] = None
-            i += 1
-            continue
+            options.update(parse_options(arg[2:]))
         elif arg.startswith("-"):
-            # Handle flags that take arguments
-            if arg in ("-t", "--types", "-L", "-U", "--source", "--target"):
-                if i + 1 < len(args):
-                    flags.extend([arg, args[i + 1]])
-                    i += 2
-                    continue
             flags.append(arg)
         else:
             positional.append(arg)
@@ -81,6 +83,27 @@ def rebuild_options(options: dict) -> str:
     return ",".join(parts)
 
 
+def spawn_output(argv: list[str]) -> tuple[int, str]:
+    """Run argv with os.posix_spawnp and return its exit status and stdout.
+
+    stderr is inherited, so the command's error messages go straight through.
+    """
+    read_fd, write_fd = os.pipe()
+    with open(read_fd, "rb") as stdout:
+        try:
+            pid = os.posix_spawnp(
+                argv[0],
+                argv,
+                os.environ,
+                file_actions=[(os.POSIX_SPAWN_DUP2, write_fd, 1)],
+            )
+        finally:
+            os.close(write_fd)
+        output = stdout.read()
+    _, status = os.waitpid(pid, 0)
+    return os.waitstatus_to_exitcode(status), output.decode()
+
+
 def setup_loop_device(source: str, options: dict) -> str | None:
     """Set up a loop device using losetup and return the device path."""
     losetup_args = [LOSETUP, "-f", "--show"]
@@ -104,12 +127,12 @@ def setup_loop_device(source: str, options: dict) -> str | None:
     losetup_args.append(source)
 
     print(f"mount-wrapper: running {losetup_args}")
-    result = subprocess.run(losetup_args, capture_output=True, text=True)
-    if result.returncode != 0:
-        print(f"losetup failed: {result.stderr}", file=sys.stderr)
+    returncode, stdout = spawn_output(losetup_args)
+    if returncode != 0:
+        print(f"losetup failed with exit status {returncode}", file=sys.stderr)
         return None
 
-    return result.stdout.strip()
+    return stdout.strip()
 
 
 def main():
@@ -120,8 +143,14 @@ def main():
     options, flags, source, target = parse_mount_args(args)
     print(f"mount-wrapper: parsed options={options}, flags={flags}, source={source}, target={target}")
 
-    # Check if loop option is specified and source is a regular file
-    use_loop = "loop" in options and source and os.path.isfile(source)
+    # Check if loop option is specified and source is a regular file; paths
+    # under /dev/ are never regular files, so skip the stat for them
+    use_loop = (
+        "loop" in options
+        and source
+        and not source.startswith("/dev/")
+        and os.path.isfile(source)
+    )
 
     if use_loop:
         print(f"mount-wrapper: loop mount requested for {source}")
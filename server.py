@@ -1,29 +1,106 @@
 #!/usr/bin/env python3
 # Copyright (C) Canonical Ltd.
 # SPDX-License-Identifier: GPL-3.0-only
-"""Simple HTTP API server using Flask."""
+"""Simple HTTP API server using aiohttp."""
 
 import argparse
-import glob
-import json
+import asyncio
+import codecs
+import http.client
+import logging
 import os
+import shutil
+import socket
+import struct
 import subprocess
 import sys
+from collections.abc import Iterator
 
-from flask import Flask, jsonify, request
+import aiohttp
+import orjson
+from aiohttp import web
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Resolve this once so each request doesn't search PATH again.
+LOSETUP_BIN = shutil.which("losetup") or "losetup"
+
+NDJSON_TYPE = "application/x-ndjson"
+
+LXD_SOCKET = "/var/snap/lxd/common/lxd/unix.socket"
+LXD_SESSION = web.AppKey("lxd_session", aiohttp.ClientSession)
+
+
+# rtnetlink(7) message layouts and constants
+NLMSGHDR = struct.Struct("=IHHII")
+RTATTR = struct.Struct("=HH")
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+
+def netlink_dump(msg_type: int, request: bytes) -> Iterator[bytes]:
+    """Send an rtnetlink dump request and yield the body of each reply."""
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as sock:
+        sock.bind((0, 0))
+        header = NLMSGHDR.pack(
+            NLMSGHDR.size + len(request), msg_type, NLM_F_REQUEST | NLM_F_DUMP, 1, 0
+        )
+        sock.send(header + request)
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset < len(data):
+                length, reply_type, _, _, _ = NLMSGHDR.unpack_from(data, offset)
+                if reply_type == NLMSG_DONE:
+                    return
+                if reply_type == NLMSG_ERROR:
+                    (error,) = struct.unpack_from("=i", data, offset + NLMSGHDR.size)
+                    raise OSError(-error, os.strerror(-error))
+                yield data[offset + NLMSGHDR.size:offset + length]
+                offset += (length + 3) & ~3
+
+
+def parse_attrs(data: bytes, offset: int) -> dict[int, bytes]:
+    """Parse the rtattrs starting at offset into a dict of type to payload."""
+    attrs = {}
+    while offset + RTATTR.size <= len(data):
+        length, attr_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attrs[attr_type] = data[offset + RTATTR.size:offset + length]
+        offset += (length + 3) & ~3
+    return attrs
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a Unix socket."""
+
+    def __init__(self, socket_path: str):
+        super().__init__("localhost")
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
 
 
 def get_container_bridge(container: str) -> str:
     """Get the bridge interface the container is attached to."""
-    result = subprocess.run(
-        ["lxc", "query", f"/1.0/instances/{container}"],
-        capture_output=True,
-        text=True,
-    )
-    if result.returncode != 0:
-        raise RuntimeError(f"Failed to query container: {result.stderr}")
+    conn = UnixHTTPConnection(LXD_SOCKET)
+    try:
+        conn.request("GET", f"/1.0/instances/{container}")
+        response = orjson.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+    if response.get("type") == "error":
+        raise RuntimeError(f"Failed to query container: {response.get('error')}")
 
-    config = json.loads(result.stdout)
+    config = response["metadata"]
     devices = config.get("expanded_devices", {})
 
     for device in devices.values():
@@ -35,95 +112,282 @@ def get_container_bridge(container: str) -> str:
     raise RuntimeError("No network device with parent found for container")
 
 
+IFADDRMSG = struct.Struct("=BBBBI")
+RTM_GETADDR = 22
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+
 def get_interface_ip(interface: str) -> str:
     """Get the IPv4 address of a network interface."""
-    result = subprocess.run(
-        ["ip", "-j", "addr", "show", interface],
-        capture_output=True,
-        text=True,
-    )
-    if result.returncode != 0:
-        raise RuntimeError(f"Failed to get interface info: {result.stderr}")
-
-    data = json.loads(result.stdout)
-    for iface in data:
-        for addr_info in iface.get("addr_info", []):
-            if addr_info.get("family") == "inet":
-                return addr_info.get("local")
+    request = IFADDRMSG.pack(socket.AF_INET, 0, 0, 0, 0)
+    try:
+        index = socket.if_nametoindex(interface)
+        for reply in netlink_dump(RTM_GETADDR, request):
+            _, _, _, _, addr_index = IFADDRMSG.unpack_from(reply)
+            if addr_index != index:
+                continue
+            attrs = parse_attrs(reply, IFADDRMSG.size)
+            addr = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+            if addr:
+                return socket.inet_ntoa(addr)
+    except OSError as e:
+        raise RuntimeError(f"Failed to get interface info: {e}") from e
 
     raise RuntimeError(f"No IPv4 address found for interface {interface}")
 
 
-app = Flask(__name__)
 container_name = None
 container_rootfs = None
+lxd_lock = asyncio.Lock()
+# Limit how many losetup processes run at once, e.g. for large batches
+losetup_slots = asyncio.Semaphore(32)
 
 
-@app.route("/losetup", methods=["POST"])
-def losetup():
-    """Run losetup with the provided arguments."""
-    data = request.get_json()
-    if data is None:
-        return jsonify({"error": "Expected JSON body"}), 400
+async def add_devices(session: aiohttp.ClientSession, dev_paths: list[str]) -> None:
+    """Add block devices to the container with a single LXD API call.
 
-    args = data.get("args", [])
-    if not isinstance(args, list) or not all(isinstance(a, str) for a in args):
-        return jsonify({"error": "args must be a list of strings"}), 400
+    Creating the device nodes directly in the container's mount namespace
+    would skip the config write, but LXD also has to allow the devices in
+    the container's cgroup device policy, which only happens when they are
+    added through LXD.
+    """
+    devices = {}
+    for dev_path in dev_paths:
+        print(f"Adding device {dev_path} to container {container_name}", file=sys.stderr)
+        devices[os.path.basename(dev_path)] = {
+            "type": "unix-block",
+            "source": dev_path,
+            "path": dev_path,
+        }
 
-    print(f"Received args: {args}", file=sys.stderr)
+    # PATCH merges the given devices into the existing ones, so concurrent
+    # PATCHes of the same instance can lose each other's devices.
+    # Failures are only logged: losetup has already set up the device, and
+    # the client still needs its path.
+    try:
+        async with lxd_lock, session.patch(
+            f"http://lxd/1.0/instances/{container_name}",
+            json={"devices": devices},
+        ) as resp:
+            if resp.status != 200:
+                body = await resp.read()
+                try:
+                    error = orjson.loads(body).get("error")
+                except (orjson.JSONDecodeError, AttributeError):
+                    error = body.decode(errors="replace")
+                print(f"Failed to add devices: {error}", file=sys.stderr)
+    except aiohttp.ClientError as e:
+        print(f"Failed to add devices: {e}", file=sys.stderr)
 
-    # Check if --show is in the args
-    has_show = "--show" in args
+
+async def lxd_session(app: web.Application):
+    """Keep a connection to the LXD socket open for the server's lifetime."""
+    connector = aiohttp.UnixConnector(path=LXD_SOCKET)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        app[LXD_SESSION] = session
+        yield
+
+
+def valid_args(args) -> bool:
+    """Check that args is a list of strings."""
+    return isinstance(args, list) and all(isinstance(a, str) for a in args)
+
+
+def losetup_command(args: list[str]) -> list[str]:
+    """Build the losetup command line for args sent by the client."""
+    print(f"Received args: {args}", file=sys.stderr)
 
     # Find the last positional argument (not an option, not a device path)
     # and prepend container_rootfs to it
-    args = list(args)  # copy to avoid modifying original
-    for i in range(len(args) - 1, -1, -1):
-        arg = args[i]
-        if not arg.startswith("-") and not arg.startswith("/dev/"):
-            args[i] = os.path.join(container_rootfs, arg)
-            break
+    last_pos = -1
+    for i, arg in enumerate(args):
+        if not arg.startswith(("-", "/dev/")):
+            last_pos = i
+    if last_pos >= 0:
+        # build a new list to avoid modifying the original
+        args = [
+            *args[:last_pos],
+            os.path.join(container_rootfs, args[last_pos]),
+            *args[last_pos + 1:],
+        ]
 
-    cmd = ["losetup"] + args
+    cmd = [LOSETUP_BIN] + args
     print(f"Running: {cmd}", file=sys.stderr)
+    return cmd
+
 
-    result = subprocess.run(
-        cmd,
-        capture_output=True,
-        text=True,
+async def spawn_losetup(cmd: list[str]) -> asyncio.subprocess.Process:
+    """Start losetup with its stdout and stderr piped back to the server."""
+    return await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        close_fds=False,
     )
 
+
+async def run_losetup(session: aiohttp.ClientSession, args: list[str]) -> dict:
+    """Run losetup and add any device it sets up to the container."""
+    # Check if --show is in the args
+    has_show = "--show" in args
+
+    cmd = losetup_command(args)
+
+    async with losetup_slots:
+        proc = await spawn_losetup(cmd)
+        stdout, stderr = await proc.communicate()
+
     response = {
-        "returncode": result.returncode,
-        "stdout": result.stdout,
-        "stderr": result.stderr,
+        "returncode": proc.returncode,
+        "stdout": stdout.decode(),
+        "stderr": stderr.decode(),
     }
 
     # If --show was used and losetup succeeded, add the device to the container
-    if has_show and result.returncode == 0:
-        device_path = result.stdout.strip()
+    if has_show and proc.returncode == 0:
+        device_path = response["stdout"].strip()
         if device_path.startswith("/dev/"):
             # Collect all devices to add: the main device plus any partitions
             devices_to_add = [device_path]
-            partition_devices = sorted(glob.glob(f"{device_path}p[0-9]*"))
+            dev_dir, base = os.path.split(device_path)
+            prefix = base + "p"
+            with os.scandir(dev_dir) as entries:
+                partition_devices = sorted(
+                    entry.path
+                    for entry in entries
+                    if entry.name.startswith(prefix) and entry.name[len(prefix):].isdigit()
+                )
             devices_to_add.extend(partition_devices)
 
-            for dev_path in devices_to_add:
-                device_name = os.path.basename(dev_path)
-                print(f"Adding device {dev_path} to container {container_name}", file=sys.stderr)
-                subprocess.run(
-                    [
-                        "lxc", "config", "device", "add",
-                        container_name,
-                        device_name,
-                        "unix-block",
-                        f"source={dev_path}",
-                        f"path={dev_path}",
-                    ],
-                    capture_output=True,
-                )
+            await add_devices(session, devices_to_add)
+
+    return response
+
+
+async def read_json(request: web.Request) -> dict | None:
+    """Return the request's JSON body, or None if it is not a JSON object."""
+    try:
+        data = orjson.loads(await request.read())
+    except orjson.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def json_response(data, status: int = 200) -> web.Response:
+    """Return data serialized as a JSON response."""
+    return web.Response(
+        body=orjson.dumps(data),
+        status=status,
+        content_type="application/json",
+    )
+
+
+async def losetup(request: web.Request) -> web.Response:
+    """Run losetup with the provided arguments."""
+    data = await read_json(request)
+    if data is None:
+        return json_response({"error": "Expected JSON body"}, status=400)
+
+    args = data.get("args", [])
+    if not valid_args(args):
+        return json_response({"error": "args must be a list of strings"}, status=400)
 
-    return jsonify(response)
+    # Only stream to clients that ask for it. With --show the device has to
+    # be added to the container before the client sees its path, so wait for
+    # the whole result.
+    if "--show" in args or NDJSON_TYPE not in request.headers.get("Accept", ""):
+        response = await run_losetup(request.app[LXD_SESSION], args)
+        return json_response(response)
+
+    return await stream_losetup(request, args)
+
+
+async def stream_losetup(request: web.Request, args: list[str]) -> web.StreamResponse:
+    """Run losetup and stream its output to the client as it is produced.
+
+    The response is newline-delimited JSON: any number of {"stdout": ...}
+    messages followed by a final {"returncode": ..., "stderr": ...}.
+    """
+    cmd = losetup_command(args)
+
+    await losetup_slots.acquire()
+    try:
+        proc = await spawn_losetup(cmd)
+    except BaseException:
+        losetup_slots.release()
+        raise
+    # Give the slot back as soon as losetup exits, rather than when a
+    # possibly slow client has read all of its output.
+    exited = asyncio.create_task(proc.wait())
+    exited.add_done_callback(lambda _: losetup_slots.release())
+    # stderr is small, so just collect it while stdout is streamed
+    stderr_task = asyncio.create_task(proc.stderr.read())
+
+    try:
+        response = web.StreamResponse()
+        response.content_type = NDJSON_TYPE
+        await response.prepare(request)
+
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        while chunk := await proc.stdout.read(4096):
+            stdout = decoder.decode(chunk)
+            if stdout:
+                await response.write(orjson.dumps({"stdout": stdout}) + b"\n")
+        stdout = decoder.decode(b"", final=True)
+        if stdout:
+            await response.write(orjson.dumps({"stdout": stdout}) + b"\n")
+
+        stderr = await stderr_task
+        await exited
+        await response.write(
+            orjson.dumps({"returncode": proc.returncode, "stderr": stderr.decode()}) + b"\n"
+        )
+        await response.write_eof()
+    finally:
+        if not stderr_task.done():
+            # The client went away: read the rest of the output so losetup
+            # can exit
+            await proc.stdout.read()
+            await stderr_task
+        await exited
+    return response
+
+
+async def losetup_batch(request: web.Request) -> web.Response:
+    """Run several losetup invocations concurrently and return all results."""
+    data = await read_json(request)
+    if data is None:
+        return json_response({"error": "Expected JSON body"}, status=400)
+
+    ops = data.get("ops", [])
+    if not isinstance(ops, list) or not all(
+        isinstance(op, dict) and valid_args(op.get("args", [])) for op in ops
+    ):
+        return json_response(
+            {"error": "ops must be a list of objects with args lists of strings"},
+            status=400,
+        )
+
+    session = request.app[LXD_SESSION]
+    results = await asyncio.gather(
+        *[run_losetup(session, op.get("args", [])) for op in ops],
+        return_exceptions=True,
+    )
+    # Report a failed op in its own slot so the other results aren't lost
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
+            print(f"Batch op {i} failed: {result!r}", file=sys.stderr)
+            results[i] = {"error": str(result)}
+    return json_response(results)
+
+
+app = web.Application()
+app.cleanup_ctx.append(lxd_session)
+app.add_routes([
+    web.post("/losetup", losetup),
+    web.post("/losetup/batch", losetup_batch),
+])
 
 
 if __name__ == "__main__":
@@ -146,4 +410,10 @@ if __name__ == "__main__":
     host = get_interface_ip(bridge)
     print(f"Container {container_name} is on bridge {bridge}, listening on {host}")
 
-    app.run(host=host, port=args.port, debug=args.debug)
+    if args.debug:
+        # Shows aiohttp's access and server logs, like Flask's debug mode did
+        logging.basicConfig(level=logging.DEBUG)
+
+    loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+    loop.set_debug(args.debug)
+    web.run_app(app, host=host, port=args.port, loop=loop)